@@ -2,13 +2,19 @@ import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 from firebase_admin import messaging
+from firebase_admin import exceptions
+import google.oauth2.credentials
+from google.api_core import retry_async
 import time
+import sys
+import logging
+import calendar
+import datetime
 import os
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import alarmChecker as ac
-from queue import Queue
-import threading
 
 # --- CONFIGURATION ---
 
@@ -16,16 +22,11 @@ import threading
 CREDENTIALS_FILENAME = 'serviceAccountKey_trackaship-live-marine-traffic-firebase-adminsdk-r6k95-642eb778c2.json' 
 CREDENTIALS_PATH = f'./{CREDENTIALS_FILENAME}'
 
-# Define the push notification payload TEMPLATE
-# The title and body will now be formatted dynamically with alert data.
-NOTIFICATION_TITLE_TEMPLATE = "🚨 Ship Alert: {alertName} Detected!"
-NOTIFICATION_BODY_TEMPLATE = "Vessel MMSI: {vesselMMSI}. This is a critical alert for the vessel you are tracking."
-NOTIFICATION_DATA_TEMPLATE = {
-    # These fields are required for the client application to handle the navigation/action
-    "vesselMMSI": "", 
-    "alertName": "",
-    "timestamp": str(int(time.time()))
-}
+# OAuth2 access token cache, reused across runs until it is close to expiry
+# Kept in a per-user directory (mode 0700), never in a shared location such as /tmp
+TOKEN_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'FirebaseAlarmSender')
+TOKEN_CACHE_PATH = os.path.join(TOKEN_CACHE_DIR, 'fcm_token.json')
+TOKEN_MIN_REMAINING_SECONDS = 300
 
 # Define the Firestore collection structure
 FULL_USERS_COLLECTION_PATH = 'users' 
@@ -40,6 +41,9 @@ RADIUS_METERS = 'radiusMeters'  # Field containing the radius in meters
 CENTER = 'center'              # Field containing the center point as a dict with 'lat' and 'lon' keys
 IS_ACTIVE_FIELD = 'isActive'   # Field indicating if alarm is active (true/false)
 
+# Fields read from each alarm document during processing (used as query projection)
+ALARM_FIELDS = [FCM_TOKEN_FIELD, MMSI_FIELD, SHIP_NAME_FIELD, MODE, CENTER, RADIUS_METERS, IS_ACTIVE_FIELD]
+
 # Audit log subcollection name
 AUDIT_LOG_SUBCOLLECTION = 'auditLogs'
 
@@ -49,95 +53,120 @@ TEST_USER_ID = 'PRFzKRIJGbSsrwC60ic9ifU9qsC3'
 TEST_ALARM_ID = 'JMYvcXgjTZUOdKcx6OUU' 
 
 # Performance configuration
-MAX_WORKERS = 10  # Number of parallel message sends
-DB_POOL_SIZE = 20  # Database connection pool size (should be >= MAX_WORKERS)
+MAX_WORKERS = 10  # Upper limit of FCM batches in flight at once (the actual limit adapts below it)
+FCM_BATCH_SIZE = 500  # Max messages per send_each call (FCM limit)
+FCM_SEND_RATE = 10000  # Max messages sent per second (token bucket rate, FCM's default quota is 600k/min)
+AIMD_SUCCESS_WINDOW = 5  # Successful batches needed before the in-flight limit is raised by one
+FIRESTORE_POOL_SIZE = 4  # Number of Firestore clients (gRPC channels) used for parallel writes
 
-# --- DATABASE CONNECTION POOL ---
+# Logging configuration
+LOG_LEVEL = logging.INFO  # Set to logging.DEBUG to also log every alarm checked
 
-class DatabaseConnectionPool:
-    """Simple connection pool for MariaDB connections."""
+logger = logging.getLogger("fcm")
 
-    def __init__(self, size=DB_POOL_SIZE):
-        self.size = size
-        self.pool = Queue(maxsize=size)
-        self._lock = threading.Lock()
-        self._initialized = False
+# --- LOGGING ---
 
-    def initialize(self):
-        """Initialize the connection pool with connections."""
-        with self._lock:
-            if self._initialized:
-                return
+def configure_logging():
+    """
+    Writes log records to stdout as they are emitted, so the cron log keeps every line in
+    order with stderr even if the process is killed.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(stream_handler)
+    logger.setLevel(LOG_LEVEL)
 
-            print(f"Initializing database connection pool (size: {self.size})...")
-            for i in range(self.size):
-                try:
-                    conn = ac.get_connection()
-                    self.pool.put(conn)
-                except Exception as e:
-                    print(f"Warning: Failed to create connection {i+1}/{self.size}: {e}")
+# --- FIRESTORE CLIENT POOL ---
 
-            self._initialized = True
-            print(f"Database connection pool initialized with {self.pool.qsize()} connections.")
+# Global pool of Firestore clients, each with its own gRPC channel (filled by initialize_firebase_app)
+firestore_clients = []
 
-    def get_connection(self, timeout=5):
-        """Get a connection from the pool."""
-        try:
-            return self.pool.get(timeout=timeout)
-        except Exception:
-            # If pool is empty, create a new connection
-            print("Warning: Pool exhausted, creating new connection...")
-            return ac.get_connection()
-
-    def return_connection(self, conn):
-        """Return a connection to the pool."""
-        try:
-            # Test if connection is still alive
-            conn.ping(reconnect=True)
-            self.pool.put_nowait(conn)
-        except Exception as e:
-            print(f"Warning: Connection failed health check, discarding: {e}")
-            try:
-                conn.close()
-            except:
-                pass
+def create_firestore_client_pool(app):
+    """Create FIRESTORE_POOL_SIZE independent Firestore clients sharing the app's credentials."""
+    google_cred = app.credential.get_credential()
+    firestore_clients[:] = [
+        firestore.Client(project=app.project_id, credentials=google_cred)
+        for _ in range(FIRESTORE_POOL_SIZE)
+    ]
+    logger.info(f"Firestore client pool initialized with {len(firestore_clients)} clients.")
 
-    def close_all(self):
-        """Close all connections in the pool."""
-        print("Closing all database connections...")
-        while not self.pool.empty():
-            try:
-                conn = self.pool.get_nowait()
-                conn.close()
-            except Exception as e:
-                print(f"Warning: Error closing connection: {e}")
+# --- INITIALIZATION ---
 
-# Global connection pool instance
-db_pool = DatabaseConnectionPool()
+class CachedTokenCredential(credentials.Base):
+    """Firebase credential backed by a cached OAuth2 access token. It cannot be refreshed."""
 
-# --- INITIALIZATION ---
+    def __init__(self, token, expiry_epoch):
+        expiry = datetime.datetime.fromtimestamp(expiry_epoch, tz=datetime.timezone.utc).replace(tzinfo=None)
+        self._g_credential = google.oauth2.credentials.Credentials(token=token, expiry=expiry)
 
-def initialize_firebase_app():
-    """Initializes the Firebase Admin SDK by loading the service account key locally."""
-    
-    if not os.path.exists(CREDENTIALS_PATH):
-        print(f"CRITICAL ERROR: Credentials file not found at '{CREDENTIALS_PATH}'.")
-        print(f"Please save your service account key as '{CREDENTIALS_FILENAME}' in this directory.")
-        return None
-        
-    project_id = None
+    def get_credential(self):
+        return self._g_credential
+
+def is_private_to_user(st):
+    """Returns True if the stat result belongs to the current user and has no group/other permissions."""
+    return st.st_uid == os.getuid() and st.st_mode & 0o077 == 0
+
+def load_cached_token():
+    """
+    Returns (token, expiry_epoch, project_id) from TOKEN_CACHE_PATH, or None if there is no
+    cached token, it expires within TOKEN_MIN_REMAINING_SECONDS, or the cache directory or file
+    is not owned by the current user with private permissions (it could have been planted).
+    """
     try:
-        # Load the JSON content to extract the project ID
-        with open(CREDENTIALS_PATH, 'r') as f:
-            cred_data = json.load(f)
-            project_id = cred_data.get('project_id')
-        
-        print(f"Service account key loaded from: {CREDENTIALS_PATH}")
-        print(f"Extracted Project ID: {project_id}")
+        if not is_private_to_user(os.stat(TOKEN_CACHE_DIR)):
+            logger.warning(f"Warning: Ignoring token cache, '{TOKEN_CACHE_DIR}' is not private to this user.")
+            return None
+
+        fd = os.open(TOKEN_CACHE_PATH, os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd, 'rb') as f:
+            if not is_private_to_user(os.fstat(f.fileno())):
+                logger.warning(f"Warning: Ignoring token cache, '{TOKEN_CACHE_PATH}' is not private to this user.")
+                return None
+            cache = orjson.loads(f.read())
+        token, expiry_epoch, project_id = cache['token'], cache['expiry_epoch'], cache['project_id']
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+        return None
 
-    except Exception as e:
-        print(f"CRITICAL ERROR: Failed to read or parse the JSON file. Details: {e}")
+    if expiry_epoch - time.time() <= TOKEN_MIN_REMAINING_SECONDS:
         return None
+    return token, expiry_epoch, project_id
+
+def save_cached_token(cred, project_id):
+    """
+    Fetches an access token for the service account credential and stores it in TOKEN_CACHE_PATH.
+    The file is written to a fresh temporary file (mode 0600, never following symlinks) and
+    atomically renamed into place.
+    """
+    tmp_path = None
+    try:
+        access_token = cred.get_access_token()
+        expiry_epoch = calendar.timegm(access_token.expiry.utctimetuple())
+
+        os.makedirs(TOKEN_CACHE_DIR, mode=0o700, exist_ok=True)
+        if not is_private_to_user(os.stat(TOKEN_CACHE_DIR)):
+            logger.warning(f"Warning: Not caching the access token, '{TOKEN_CACHE_DIR}' is not private to this user.")
+            return
+
+        tmp_path = f"{TOKEN_CACHE_PATH}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps({'token': access_token.access_token, 'expiry_epoch': expiry_epoch, 'project_id': project_id}))
+        os.replace(tmp_path, TOKEN_CACHE_PATH)
+        tmp_path = None
+    except Exception as e:
+        logger.warning(f"Warning: Could not cache the access token. Details: {e}")
+    finally:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def initialize_firebase_app():
+    """
+    Initializes the Firebase Admin SDK, reusing a cached access token when one is still valid
+    and otherwise loading the service account key locally.
+    """
 
     # Check if the app is already initialized (important for notebooks/environments that persist state)
     default_app = None
@@ -147,22 +176,64 @@ def initialize_firebase_app():
         pass # App is not initialized yet
 
     if default_app:
-        print("--- Firebase Admin SDK already initialized. Reusing existing client. ---")
+        logger.info("--- Firebase Admin SDK already initialized. Reusing existing client. ---")
         db = firestore.client(app=default_app)
+        create_firestore_client_pool(default_app)
         return db
 
+    cached = load_cached_token()
+    if cached:
+        token, expiry_epoch, project_id = cached
+        try:
+            firebase_admin.initialize_app(CachedTokenCredential(token, expiry_epoch), {'projectId': project_id})
+            logger.info(f"--- Firebase Admin SDK Initialized from cached access token (valid for {int(expiry_epoch - time.time())}s) ---")
+
+            db = firestore.client(app=firebase_admin.get_app())
+            create_firestore_client_pool(firebase_admin.get_app())
+            return db
+        except Exception as e:
+            logger.warning(f"Warning: Failed to initialize from cached access token, using the service account key. Details: {e}")
+            try:
+                firebase_admin.delete_app(firebase_admin.get_app())
+            except ValueError:
+                pass
+
+    if not os.path.exists(CREDENTIALS_PATH):
+        logger.error(f"CRITICAL ERROR: Credentials file not found at '{CREDENTIALS_PATH}'.")
+        logger.error(f"Please save your service account key as '{CREDENTIALS_FILENAME}' in this directory.")
+        return None
+        
+    project_id = None
+    try:
+        # Load the JSON content to extract the project ID
+        with open(CREDENTIALS_PATH, 'rb') as f:
+            cred_data = orjson.loads(f.read())
+            project_id = cred_data.get('project_id')
+        
+        logger.info(f"Service account key loaded from: {CREDENTIALS_PATH}")
+        logger.info(f"Extracted Project ID: {project_id}")
+
+    except Exception as e:
+        logger.error(f"CRITICAL ERROR: Failed to read or parse the JSON file. Details: {e}")
+        return None
+
     try:
-        cred = credentials.Certificate(CREDENTIALS_PATH)
+        # Reuse the parsed key instead of letting the SDK read and parse the file again
+        cred = credentials.Certificate(cred_data)
         
         firebase_admin.initialize_app(cred, {'projectId': project_id})
-        print("--- Firebase Admin SDK Initialized Successfully ---")
+        logger.info("--- Firebase Admin SDK Initialized Successfully ---")
+
+        # Fetch the access token now and keep it for the next runs
+        save_cached_token(cred, project_id)
         
         # Explicitly target the default database instance
         db = firestore.client(app=firebase_admin.get_app())
+        create_firestore_client_pool(firebase_admin.get_app())
         return db
     except Exception as e:
-        print(f"CRITICAL ERROR: Failed to initialize Firebase Admin SDK.")
-        print(f"Details: {e}")
+        logger.error(f"CRITICAL ERROR: Failed to initialize Firebase Admin SDK.")
+        logger.error(f"Details: {e}")
         return None
     
 # --- DIAGNOSTIC CHECK ---
@@ -172,17 +243,17 @@ def test_read_access(db):
     Tests if the Admin SDK can read a known alarm document and check for the required fields.
     """
     if not TEST_USER_ID or not TEST_ALARM_ID:
-        print("\n--- Skipping direct read test: TEST IDs are missing. ---")
+        logger.info("\n--- Skipping direct read test: TEST IDs are missing. ---")
         return True
         
-    print(f"\n--- Running Diagnostic Read Test ---")
+    logger.info(f"\n--- Running Diagnostic Read Test ---")
     doc_path = f"{FULL_USERS_COLLECTION_PATH}/{TEST_USER_ID}/{ALERTS_SUBCOLLECTION}/{TEST_ALARM_ID}"
     doc_ref = db.document(doc_path)
     
     try:
         doc = doc_ref.get()
         if doc.exists:
-            print(f"SUCCESS: Found document at '{doc_path}'. Read access confirmed.")
+            logger.info(f"SUCCESS: Found document at '{doc_path}'. Read access confirmed.")
             
             data = doc.to_dict()
             mmsi = data.get(MMSI_FIELD)
@@ -198,11 +269,11 @@ def test_read_access(db):
             #     print(f"  > Required fields found: MMSI='{mmsi}', Name='{alert_name}', Token present.")
 
             if mmsi and alert_name and token and mode and latitude and longitude and radius:
-                print(f"  > Required fields found: MMSI='{mmsi}', Name='{alert_name}', Token present. Mode='{mode}', Center={center}, Center=({latitude}, {longitude}), Radius={radius} meters.")
+                logger.info(f"  > Required fields found: MMSI='{mmsi}', Name='{alert_name}', Token present. Mode='{mode}', Center={center}, Center=({latitude}, {longitude}), Radius={radius} meters.")
                 if mode=='inside_radius':
-                    print("  > Alert mode is 'inside_radius'. Checking if ship is within radius...")
+                    logger.info("  > Alert mode is 'inside_radius'. Checking if ship is within radius...")
                     # Get connection from pool
-                    db_conn = db_pool.get_connection()
+                    db_conn = ac.get_connection()
                     try:
                         cursor = db_conn.cursor()
                         within_radius, distance, ship_lat, ship_lon = ac.is_ship_within_radius(
@@ -215,16 +286,16 @@ def test_read_access(db):
                         )
                         cursor.close()
                         if within_radius:
-                            print(f"  > Ship with MMSI {mmsi} IS within the radius of {radius} meters.")
+                            logger.info(f"  > Ship with MMSI {mmsi} IS within the radius of {radius} meters.")
                         else:
-                            print(f"  > Ship with MMSI {mmsi} is NOT within the radius of {radius} meters.")
+                            logger.info(f"  > Ship with MMSI {mmsi} is NOT within the radius of {radius} meters.")
                     finally:
                         # Return connection to pool
-                        db_pool.return_connection(db_conn)
+                        db_conn.close()
                 elif mode=='outside_radius':
-                    print("  > Alert mode is 'outside_radius'. Checking if ship is outside radius...")
+                    logger.info("  > Alert mode is 'outside_radius'. Checking if ship is outside radius...")
                     # Get connection from pool
-                    db_conn = db_pool.get_connection()
+                    db_conn = ac.get_connection()
                     try:
                         cursor = db_conn.cursor()
                         outside_radius, distance, ship_lat, ship_lon = ac.is_ship_outside_radius(
@@ -236,253 +307,344 @@ def test_read_access(db):
                         )
                         cursor.close()
                         if outside_radius:
-                            print(f"  > Ship with MMSI {mmsi} IS outside the radius of {radius} meters.")
+                            logger.info(f"  > Ship with MMSI {mmsi} IS outside the radius of {radius} meters.")
                         else:
-                            print(f"  > Ship with MMSI {mmsi} is NOT outside the radius of {radius} meters.")
+                            logger.info(f"  > Ship with MMSI {mmsi} is NOT outside the radius of {radius} meters.")
                     finally:
                         # Return connection to pool
-                        db_pool.return_connection(db_conn)
+                        db_conn.close()
                 return True
             else:
-                 print(f"FAILURE: Document found, but missing required fields ('{MMSI_FIELD}', '{SHIP_NAME_FIELD}', or '{FCM_TOKEN_FIELD}').")
+                 logger.warning(f"FAILURE: Document found, but missing required fields ('{MMSI_FIELD}', '{SHIP_NAME_FIELD}', or '{FCM_TOKEN_FIELD}').")
                  return False
         else:
-            print(f"FAILURE: Cannot find document at known path '{doc_path}'.")
+            logger.warning(f"FAILURE: Cannot find document at known path '{doc_path}'.")
             return False
     except Exception as e:
-        print(f"CRITICAL FAILURE: Error during read attempt: {e}")
-        print("  This is usually due to an Admin SDK permission issue (e.g., service account role is too restrictive).")
+        logger.error(f"CRITICAL FAILURE: Error during read attempt: {e}")
+        logger.error("  This is usually due to an Admin SDK permission issue (e.g., service account role is too restrictive).")
         return False
 
 
 # --- MESSAGE SENDING LOGIC (PARALLEL) ---
 
-def send_single_fcm_message(message_data):
-    """Send a single FCM message. Designed to be called in parallel."""
+def build_fcm_message(message_data, batch_ts):
+    """Build the FCM message for a single triggered alert (without sending it)."""
     token, mmsi, alert_name, alert_id, mode, radius = message_data
     
     # Format the dynamic content
-    title = NOTIFICATION_TITLE_TEMPLATE.format(alertName=alert_name)
-    body = NOTIFICATION_BODY_TEMPLATE.format(vesselMMSI=mmsi)
-    
-    # Populate the data payload
-    data_payload = NOTIFICATION_DATA_TEMPLATE.copy()
-    data_payload["vesselMMSI"] = str(mmsi)
-    data_payload["alertName"] = alert_name
-    data_payload["timestamp"] = str(int(time.time()))
-    data_payload["mode"] = str(mode)
-    data_payload["radius"] = str(radius)
-
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data=data_payload,
+    title = f"🚨 Ship Alert: {alert_name} Detected!"
+    body = f"Vessel MMSI: {mmsi}. This is a critical alert for the vessel you are tracking."
+
+    return messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        # These fields are required for the client application to handle the navigation/action
+        data={
+            "vesselMMSI": str(mmsi),
+            "alertName": str(alert_name),
+            "timestamp": batch_ts,
+            "mode": str(mode),
+            "radius": str(radius),
+        },
         token=token,
         apns=messaging.APNSConfig(
             payload=messaging.APNSPayload(
                 aps=messaging.Aps(
-                    alert=messaging.ApsAlert(
-                        title=title,
-                        body=body
-                    ),
+                    alert=messaging.ApsAlert(title=title, body=body),
                     sound="default",
                     badge=1,
-                    content_available=True, 
+                    content_available=True,
                 ),
             ),
         ),
     )
 
+def is_invalid_token_error(exception):
+    """Returns True if the FCM error means the device token is stale or malformed."""
+    return isinstance(exception, (messaging.UnregisteredError, exceptions.InvalidArgumentError))
+
+# Errors worth retrying: the message may succeed when sent again after a backoff
+TRANSIENT_SEND_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.ResourceExhaustedError,
+)
+
+# Jittered exponential backoff for transient FCM failures, up to 60 seconds per batch
+SEND_RETRY = retry_async.AsyncRetry(
+    predicate=retry_async.if_exception_type(*TRANSIENT_SEND_ERRORS),
+    initial=0.5,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=60.0,
+)
+
+class AdaptiveSendLimiter:
+    """
+    Limits FCM sending with an AIMD concurrency limit (halved on quota errors, raised by one
+    after AIMD_SUCCESS_WINDOW clean batches, never above max_limit) and a token bucket on the
+    message rate. Must be created inside the running event loop.
+    """
+
+    def __init__(self, max_limit=MAX_WORKERS, rate=FCM_SEND_RATE):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.rate = rate
+        self.tokens = rate  # Bucket capacity is one second worth of messages
+        self.last_refill = time.monotonic()
+        self._condition = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire_slot(self):
+        """Wait for a free in-flight slot. Every acquired slot must be freed with release()."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def take_tokens(self, message_count):
+        """Wait for enough tokens to send message_count messages. Called before every send attempt."""
+        needed = min(message_count, self.rate)
+        while True:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= needed
+                return
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    async def release(self, throttled):
+        """Free the slot and adjust the limit: halve it if the batch was throttled, else count a success."""
+        async with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                logger.warning(f"     [THROTTLED] FCM quota exceeded, lowering batches in flight to {self.limit}")
+            else:
+                self.successes += 1
+                if self.successes >= AIMD_SUCCESS_WINDOW and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self._condition.notify_all()
+
+async def send_fcm_batch(batch, batch_ts, limiter):
+    """
+    Send one batch of (at most FCM_BATCH_SIZE) messages with send_each_async, resending the
+    messages that failed with a transient error (SEND_RETRY backoff). Returns a list of
+    per-message result dicts, in the same order as the batch.
+    """
+    messages = [build_fcm_message(msg, batch_ts) for msg in batch]
+    responses = [(False, None, None)] * len(messages)
+    pending = list(range(len(messages)))
+    throttled = False
+
+    async def send_pending():
+        """Send the messages that have not succeeded yet; raise if any of them failed transiently."""
+        nonlocal pending, throttled
+        # Retries draw tokens too, so resends after quota errors stay within the rate limit
+        await limiter.take_tokens(len(pending))
+        try:
+            batch_response = await messaging.send_each_async([messages[i] for i in pending])
+        except Exception as e:
+            # The whole request failed (e.g. auth or transport error), so every pending message failed
+            for i in pending:
+                responses[i] = (False, None, e)
+            throttled = throttled or isinstance(e, exceptions.ResourceExhaustedError)
+            raise
+
+        still_pending = []
+        for i, resp in zip(pending, batch_response.responses):
+            responses[i] = (resp.success, resp.message_id, resp.exception)
+            if not resp.success and isinstance(resp.exception, TRANSIENT_SEND_ERRORS):
+                still_pending.append(i)
+            throttled = throttled or isinstance(resp.exception, exceptions.ResourceExhaustedError)
+        pending = still_pending
+        if pending:
+            raise responses[pending[0]][2]
+
+    await limiter.acquire_slot()
     try:
-        response = messaging.send(message)
-        return {'success': True, 'alert_name': alert_name, 'mmsi': mmsi, 'response': response}
-    except Exception as e:
-        error_msg = str(e)
-        is_invalid_token = 'not registered' in error_msg.lower() or 'invalid registration' in error_msg.lower()
-        return {
-            'success': False, 
-            'alert_name': alert_name, 
-            'mmsi': mmsi, 
-            'error': error_msg,
-            'invalid_token': is_invalid_token
-        }
+        await SEND_RETRY(send_pending)()
+    except Exception:
+        # Retries exhausted or a permanent error; responses hold the last error of each failed message
+        pass
+    await limiter.release(throttled)
+
+    results = []
+    for msg, (success, message_id, error) in zip(batch, responses):
+        token, mmsi, alert_name = msg[0], msg[1], msg[2]
+        if success:
+            results.append({'success': True, 'alert_name': alert_name, 'mmsi': mmsi, 'response': message_id})
+        else:
+            results.append({
+                'success': False,
+                'alert_name': alert_name,
+                'mmsi': mmsi,
+                'error': str(error),
+                'invalid_token': is_invalid_token_error(error)
+            })
+    return results
+
+async def send_batches_async(batches):
+    """Send all batches concurrently on one event loop, bounded by an AdaptiveSendLimiter."""
+    # One timestamp for the whole send, so every notification of a run carries the same value
+    batch_ts = str(int(time.time()))
+
+    # With several batches, warm up with a dry-run send so the access token is fetched and the
+    # HTTP/2 connection is open before the concurrent sends start, instead of every first request
+    # racing to set them up. A single batch has nothing to race with, so it is sent directly
+    if len(batches) > 1:
+        try:
+            await messaging.send_each_async([build_fcm_message(batches[0][0], batch_ts)], dry_run=True)
+        except Exception as e:
+            logger.warning(f"  Warning: FCM warm-up send failed, continuing without it. Details: {e}")
+
+    limiter = AdaptiveSendLimiter()
+    batch_results = await asyncio.gather(*[send_fcm_batch(batch, batch_ts, limiter) for batch in batches])
+    return [result for results in batch_results for result in results]
 
 def send_messages_parallel(messages_to_send):
-    """Send multiple messages in parallel using ThreadPoolExecutor."""
+    """Send messages in batches of FCM_BATCH_SIZE, with the batches sent concurrently via asyncio."""
     if not messages_to_send:
         return 0, 0
     
     success_count = 0
     failure_count = 0
     invalid_token_count = 0
+
+    batches = [messages_to_send[i:i + FCM_BATCH_SIZE] for i in range(0, len(messages_to_send), FCM_BATCH_SIZE)]
     
-    print(f"  >> Sending {len(messages_to_send)} messages in parallel (max {MAX_WORKERS} workers)...")
+    logger.info(f"  >> Sending {len(messages_to_send)} messages in {len(batches)} batch(es) (max {MAX_WORKERS} in flight)...")
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all tasks
-        future_to_message = {executor.submit(send_single_fcm_message, msg): msg for msg in messages_to_send}
-        
-        # Process results as they complete
-        for future in as_completed(future_to_message):
-            result = future.result()
-            
-            if result['success']:
-                success_count += 1
+    for result in asyncio.run(send_batches_async(batches)):
+        if result['success']:
+            success_count += 1
+        else:
+            failure_count += 1
+            if result.get('invalid_token'):
+                invalid_token_count += 1
             else:
-                failure_count += 1
-                if result.get('invalid_token'):
-                    invalid_token_count += 1
-                else:
-                    print(f"     [FAILURE] {result['alert_name']} (MMSI: {result['mmsi']}): {result['error']}")
+                logger.warning("     [FAILURE] %s (MMSI: %s): %s", result['alert_name'], result['mmsi'], result['error'])
     
-    print(f"  [RESULT] Sent: {success_count}, Failed: {failure_count} (Invalid tokens: {invalid_token_count})")
+    logger.info(f"  [RESULT] Sent: {success_count}, Failed: {failure_count} (Invalid tokens: {invalid_token_count})")
     return success_count, failure_count
 
-def process_user_alerts_collect(db, user_id, messages_to_send, stats):
-    """Helper function to collect alerts for a single user."""
-    alerts_ref = db.collection(FULL_USERS_COLLECTION_PATH).document(user_id).collection(ALERTS_SUBCOLLECTION)
-    alerts_found_for_user = 0
-    alerts_triggered = 0
-
+def process_alert_collect(user_id, alert_doc, candidates, stats):
+    """Helper function to validate a single alarm document and collect it for the batch radius check."""
+    alert_id = alert_doc.id
+    alert_data = alert_doc.to_dict()
+    logger.debug("Checking alarm %s for user %s: %s", alert_id, user_id, alert_data)
+
+    stats['total_alerts_checked'] += 1
+
+    fcm_token = alert_data.get(FCM_TOKEN_FIELD)
+    mmsi = alert_data.get(MMSI_FIELD)
+    alert_name = alert_data.get(SHIP_NAME_FIELD)
+    mode = alert_data.get(MODE)
+    center = alert_data.get(CENTER)
+    radius = alert_data.get(RADIUS_METERS)
+    is_active = alert_data.get(IS_ACTIVE_FIELD, False)
+
+    # Extract lat/lon from center
+    latitude = center.get('lat') if center else None
+    longitude = center.get('lon') if center else None
+
+    # Skip if alarm is not active
+    if not is_active:
+        return
+
+    # Check if all required fields are present. A token that is not a string would fail the
+    # encoding of the whole FCM batch it is sent in, so it counts as invalid here
+    if not (fcm_token and isinstance(fcm_token, str) and mmsi and alert_name and mode and latitude and longitude and radius):
+        stats['skipped_invalid'] += 1
+        return
+
+    # Only these two modes can trigger an alarm
+    if mode not in ('inside_radius', 'outside_radius'):
+        return
+
+    candidates.append({
+        'alert_id': alert_id,
+        'ref': alert_doc.reference,
+        'token': fcm_token,
+        'mmsi': mmsi,
+        'name': alert_name,
+        'mode': mode,
+        'lat': latitude,
+        'lon': longitude,
+        'radius': radius,
+    })
+
+def check_alarm_conditions(candidates, stats):
+    """
+    Checks the radius condition of all collected alarms with one SQL query and one vectorized
+    distance computation. Returns a list of (candidate, distance, ship_lat, ship_lon) for triggered alarms.
+    """
+    if not candidates:
+        return []
 
+    db_conn = ac.get_connection()
     try:
-        alerts_stream = alerts_ref.stream()
-        print(f"  >> Scanning alerts for user {user_id}...")
+        # Unbuffered cursor: positions are streamed instead of buffered as one result set
+        cursor = ac.get_stream_cursor(db_conn)
+        triggered, distances, ship_lats, ship_lons = ac.check_ships_radius(
+            cursor,
+            [c['mmsi'] for c in candidates],
+            [c['lat'] for c in candidates],
+            [c['lon'] for c in candidates],
+            [c['radius'] for c in candidates],
+            [c['mode'] == 'inside_radius' for c in candidates],
+        )
+        cursor.close()
     except Exception as e:
-        print(f"  WARNING: Could not access alerts subcollection for user {user_id}. Details: {e}")
-        return messages_to_send, stats
-
-    for alert_doc in alerts_stream:
-        alert_id = alert_doc.id
-        alert_data = alert_doc.to_dict()
-        # if user_id == "1kK0DfUo6XcYlCKZ2EYblz2LbVD2":
-        print(f"[DEBUG] Checking alarm {alert_id} for user {user_id}: {alert_data}")
-# 
-        stats['total_alerts_checked'] += 1
-        alerts_found_for_user += 1
-
-        fcm_token = alert_data.get(FCM_TOKEN_FIELD)
-        mmsi = alert_data.get(MMSI_FIELD)
-        alert_name = alert_data.get(SHIP_NAME_FIELD)
-        mode = alert_data.get(MODE)
-        center = alert_data.get(CENTER)
-        radius = alert_data.get(RADIUS_METERS)
-        is_active = alert_data.get(IS_ACTIVE_FIELD, False)
-
-        # Extract lat/lon from center
-        latitude = center.get('lat') if center else None
-        longitude = center.get('lon') if center else None
-
-        # Skip if alarm is not active
-        if not is_active:
-            continue
-
-        # Check if all required fields are present
-        if not (fcm_token and mmsi and alert_name and mode and latitude and longitude and radius):
-            missing = []
-            if not fcm_token: missing.append(FCM_TOKEN_FIELD)
-            if not mmsi: missing.append(MMSI_FIELD)
-            if not alert_name: missing.append(SHIP_NAME_FIELD)
-            if not mode: missing.append(MODE)
-            if not latitude or not longitude: missing.append(CENTER)
-            if not radius: missing.append(RADIUS_METERS)
-            stats['skipped_invalid'] += 1
-            continue
-
-        # Check if alarm condition is met
-        alarm_triggered = False
-        distance = None
-        ship_lat = None
-        ship_lon = None
-
-        db_conn = db_pool.get_connection()
-        try:
-            cursor = db_conn.cursor()
-
-            if mode == 'inside_radius':
-                alarm_triggered, distance, ship_lat, ship_lon = ac.is_ship_within_radius(
-                    cursor, mmsi, latitude, longitude, radius, closer=True
-                )
-            elif mode == 'outside_radius':
-                alarm_triggered, distance, ship_lat, ship_lon = ac.is_ship_outside_radius(
-                    cursor, mmsi, latitude, longitude, radius
-                )
-
-            cursor.close()
-        except Exception as e:
-            print(f"  WARNING: Error checking alarm condition for {alert_name} (MMSI: {mmsi}): {e}")
-            stats['skipped_invalid'] += 1
-        finally:
-            db_pool.return_connection(db_conn)
-
-        # Only add to messages if alarm condition is met
-        if alarm_triggered:
-            messages_to_send.append((fcm_token, mmsi, alert_name, alert_id, mode, radius))
-            alerts_triggered += 1
-            print(f"    - Triggered: {alert_name} (MMSI: {mmsi}, Mode: {mode}, Center: ({latitude}, {longitude}), Radius: {radius}m)")
-
-            # Create audit log
-            try:
-                audit_log_data = {
-                    'timestamp': firestore.SERVER_TIMESTAMP,
-                    'mmsi': mmsi,
-                    'alertName': alert_name,
-                    'mode': mode,
-                    'center': {'lat': latitude, 'lon': longitude},
-                    'radiusMeters': radius,
-                    'vesselPosition': {'lat': ship_lat, 'lon': ship_lon} if ship_lat and ship_lon else None,
-                    'distance': distance,
-                    'notificationSent': True
-                }
-
-                # Add audit log to subcollection
-                audit_log_ref = db.collection(FULL_USERS_COLLECTION_PATH).document(user_id).collection(ALERTS_SUBCOLLECTION).document(alert_id).collection(AUDIT_LOG_SUBCOLLECTION)
-                audit_log_ref.add(audit_log_data)
-
-                # Set isActive to false
-                alert_ref = db.collection(FULL_USERS_COLLECTION_PATH).document(user_id).collection(ALERTS_SUBCOLLECTION).document(alert_id)
-                alert_ref.update({IS_ACTIVE_FIELD: False})
-
-            except Exception as e:
-                print(f"    WARNING: Failed to create audit log or update isActive for {alert_name}: {e}")
-
-    if alerts_found_for_user > 0:
-        print(f"  > User {user_id}: Found {alerts_found_for_user} alert(s), {alerts_triggered} triggered")
-
-    return messages_to_send, stats
-
-def get_all_user_ids_with_alarms(db):
-    """
-    Returns a set of user IDs that have at least one alarm document.
-    This works even if the user document itself is empty.
-    """
-    users_with_alarms = set()
-    users_ref = db.collection(FULL_USERS_COLLECTION_PATH)
+        logger.warning(f"  WARNING: Error checking alarm conditions for {len(candidates)} alarm(s): {e}")
+        stats['skipped_invalid'] += len(candidates)
+        return []
+    finally:
+        db_conn.close()
+
+    return [
+        (candidates[i], float(distances[i]), float(ship_lats[i]), float(ship_lons[i]))
+        for i in triggered.nonzero()[0]
+    ]
+
+def record_triggered_alert(client, candidate, distance, ship_lat, ship_lon):
+    """Writes the audit log for a triggered alarm and deactivates it, using the given Firestore client."""
+    alert_ref = client.document(candidate['ref'].path)
     try:
-        # List all user document references (even if empty)
-        user_docs = list(users_ref.list_documents())
-        for user_doc_ref in user_docs:
-            user_id = user_doc_ref.id
-            # Check if the user has any alarms
-            alarms_ref = user_doc_ref.collection(ALERTS_SUBCOLLECTION)
-            try:
-                alarms = list(alarms_ref.limit(1).stream())
-                if alarms:
-                    users_with_alarms.add(user_id)
-            except Exception as e:
-                print(f"  WARNING: Could not access alarms for user {user_id}: {e}")
+        audit_log_data = {
+            'timestamp': firestore.SERVER_TIMESTAMP,
+            'mmsi': candidate['mmsi'],
+            'alertName': candidate['name'],
+            'mode': candidate['mode'],
+            'center': {'lat': candidate['lat'], 'lon': candidate['lon']},
+            'radiusMeters': candidate['radius'],
+            'vesselPosition': {'lat': ship_lat, 'lon': ship_lon},
+            'distance': distance,
+            'notificationSent': True
+        }
+
+        # Add audit log to subcollection
+        alert_ref.collection(AUDIT_LOG_SUBCOLLECTION).add(audit_log_data)
+
+        # Set isActive to false
+        alert_ref.update({IS_ACTIVE_FIELD: False})
+
     except Exception as e:
-        print(f"CRITICAL ERROR: Could not list user documents. Details: {e}")
-    return users_with_alarms
+        logger.warning(f"    WARNING: Failed to create audit log or update isActive for {candidate['name']}: {e}")
 
 def process_all_alerts(db):
     """
-    Iterates through all users and all of their alerts, sending notifications in parallel.
+    Scans every alarm of every user with one collection-group query, sending notifications in parallel.
     """
-    print(f"\n--- Starting Parallel Alert Processing ---")
-    print(f"Max parallel workers: {MAX_WORKERS}")
+    logger.info(f"\n--- Starting Parallel Alert Processing ---")
+    logger.info(f"Max batches in flight: {MAX_WORKERS}")
     
     stats = {
         'total_users_processed': 0,
@@ -490,72 +652,108 @@ def process_all_alerts(db):
         'total_sent': 0,
         'total_failed': 0,
         'skipped_invalid': 0,
+        'skipped_duplicate': 0,
     }
     
+    candidates = []
     messages_to_send = []
     processed_user_ids = set()
 
-    # --- Step 1: Get all user IDs that have at least one alarm ---
-    user_ids_with_alarms = get_all_user_ids_with_alarms(db)
-    print("All user IDs with at least one alarm in Firestore:")
-    for user_id in user_ids_with_alarms:
-        print(f" - {user_id}")
-
-    # --- Step 2: Process each user with alarms ---
-    for user_id in user_ids_with_alarms:
-        print(f"\nProcessing User: {user_id}")
-        # Skip if already processed
-        if user_id in processed_user_ids:
-            continue
-
-        stats['total_users_processed'] += 1
-        messages_to_send, stats = process_user_alerts_collect(
-            db, user_id, messages_to_send, stats
-        )
-        processed_user_ids.add(user_id)
-        print(f"> Finished processing user {user_id}")
+    # --- Step 1: Stream all alarms of all users in a single query ---
+    # This also covers users whose user document is empty, since only the alarm documents are read.
+    # The stream is lazy: the RPC runs (and can fail) while iterating, so the loop is inside the try
+    try:
+        # Only fetch the fields that are actually read, not the whole alarm document
+        alarms_stream = db.collection_group(ALERTS_SUBCOLLECTION).select(ALARM_FIELDS).stream()
+
+        # --- Step 2: Validate each alarm ---
+        for alert_doc in alarms_stream:
+            # alarms live at users/{userId}/alarms/{alarmId}; skip same-named collections elsewhere
+            user_ref = alert_doc.reference.parent.parent
+            if user_ref is None or user_ref.parent.id != FULL_USERS_COLLECTION_PATH:
+                continue
+
+            processed_user_ids.add(user_ref.id)
+            process_alert_collect(user_ref.id, alert_doc, candidates, stats)
+    except Exception as e:
+        logger.error(f"CRITICAL ERROR: Could not query the '{ALERTS_SUBCOLLECTION}' collection group. Details: {e}")
+        return
+
+    stats['total_users_processed'] = len(processed_user_ids)
+
+    # --- Step 3: Check all radius conditions in one batch ---
+    triggered_alerts = check_alarm_conditions(candidates, stats)
+    for candidate, distance, ship_lat, ship_lon in triggered_alerts:
+        messages_to_send.append((
+            candidate['token'], candidate['mmsi'], candidate['name'],
+            candidate['alert_id'], candidate['mode'], candidate['radius']
+        ))
+        logger.info("    - Triggered: %s (MMSI: %s, Mode: %s, Center: (%s, %s), Radius: %sm, Distance: %.0fm)",
+                    candidate['name'], candidate['mmsi'], candidate['mode'],
+                    candidate['lat'], candidate['lon'], candidate['radius'], distance)
+
+    # Write audit logs in parallel, round-robin over the Firestore client pool
+    clients = firestore_clients or [db]
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        for i, triggered in enumerate(triggered_alerts):
+            executor.submit(record_triggered_alert, clients[i % len(clients)], *triggered)
+
+    # --- Step 4: Send all collected messages in parallel ---
+    # A device only needs one notification per vessel, however many alarms triggered for it
+    seen = set()
+    unique_messages = []
+    for msg in messages_to_send:
+        key = (msg[0], msg[1])
+        if key not in seen:
+            seen.add(key)
+            unique_messages.append(msg)
+    stats['skipped_duplicate'] = len(messages_to_send) - len(unique_messages)
+    if stats['skipped_duplicate']:
+        logger.info(f"  >> Removed {stats['skipped_duplicate']} duplicate message(s) for the same device and vessel")
+    messages_to_send = unique_messages
 
-    # --- Step 3: Send all collected messages in parallel ---
     if messages_to_send:
-        print(f"\n{'='*60}")
+        logger.info(f"\n{'='*60}")
         success, failure = send_messages_parallel(messages_to_send)
         stats['total_sent'] = success
         stats['total_failed'] = failure
 
     # --- Summary ---
-    print(f"\n{'='*60}")
-    print(f"--- Processing Complete ---")
-    print(f"{'='*60}")
-    print(f"Users processed:        {stats['total_users_processed']}")
-    print(f"Alerts checked:         {stats['total_alerts_checked']}")
-    print(f"Messages sent:          {stats['total_sent']}")
-    print(f"Messages failed:        {stats['total_failed']}")
-    print(f"Skipped (invalid data): {stats['skipped_invalid']}")
-    print(f"{'='*60}")
+    logger.info(f"\n{'='*60}")
+    logger.info(f"--- Processing Complete ---")
+    logger.info(f"{'='*60}")
+    logger.info(f"Users processed:        {stats['total_users_processed']}")
+    logger.info(f"Alerts checked:         {stats['total_alerts_checked']}")
+    logger.info(f"Messages sent:          {stats['total_sent']}")
+    logger.info(f"Messages failed:        {stats['total_failed']}")
+    logger.info(f"Skipped (invalid data): {stats['skipped_invalid']}")
+    logger.info(f"Skipped (duplicates):   {stats['skipped_duplicate']}")
+    logger.info(f"{'='*60}")
 
 
 if __name__ == "__main__":
 
-    try:
-        # 1. Initialize database connection pool
-        db_pool.initialize()
+    configure_logging()
 
-        # 2. Run initialization and get the Firestore client
+    try:
+        # 1. Run initialization and get the Firestore client
         firestore_client = initialize_firebase_app()
 
         if firestore_client:
-            # 3. Run diagnostic check
+            # 2. Run diagnostic check
             if True: #test_read_access(firestore_client):
-                # 4. Process all data and send notifications in parallel
+                # 3. Process all data and send notifications in parallel
                 start_time = time.time()
                 process_all_alerts(firestore_client)
                 elapsed_time = time.time() - start_time
-                print(f"\nTotal execution time: {elapsed_time:.2f} seconds")
+                logger.info(f"\nTotal execution time: {elapsed_time:.2f} seconds")
             else:
-                print("\nFATAL ERROR: Access test failed. Cannot proceed with alert processing.")
+                logger.error("\nFATAL ERROR: Access test failed. Cannot proceed with alert processing.")
 
     finally:
-        # Clean up database connections
-        db_pool.close_all()
+        # Clean up database connections and Firestore channels
+        ac.close_pool()
+        for client in firestore_clients:
+            client.close()
 
-    print("\nScript finished execution.")
\ No newline at end of file
+    logger.info("\nScript finished execution.")
\ No newline at end of file
@@ -3,8 +3,25 @@
 MariaDB Database Connection Module for Alarm Checker
 """
 
+import os
 import pymysql
 import math
+import threading
+import logging
+import numpy as np
+from dbutils.pooled_db import PooledDB
+
+# Numba JIT for the distance calculations, off by default (set ALARMCHECKER_USE_NUMBA=1 to enable).
+# Importing numba and loading its cached machine code costs more per run than the compiled loop
+# saves at realistic alarm counts, so it only pays off for very large batches.
+USE_NUMBA = os.environ.get('ALARMCHECKER_USE_NUMBA') == '1'
+
+numba = None
+if USE_NUMBA:
+    try:
+        import numba
+    except ImportError:
+        pass  # Numba is not installed; the plain math/NumPy versions are used
 
 # Database credentials
 DB_HOST = "127.0.0.1"
@@ -12,27 +29,79 @@ DB_USER = "iphone_user"
 DB_PASSWORD = "shipaholic"
 DB_NAME = "vesselinfo"
 
+logger = logging.getLogger("fcm.alarm_checker")
+
+# Earth radius in meters, shared by haversine() and haversine_vec()
+EARTH_RADIUS_M = 6371000
+
+
+# Connection pool settings
+DB_POOL_SIZE = 8  # Max open connections kept by the pool
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Create the connection pool on first use and return it."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PooledDB(
+                creator=pymysql,
+                maxconnections=DB_POOL_SIZE,
+                blocking=True,  # Wait for a free connection instead of failing when exhausted
+                ping=1,  # Check (and reconnect) a connection whenever it is taken from the pool
+                host=DB_HOST,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                database=DB_NAME,
+                charset='utf8mb4',
+                cursorclass=pymysql.cursors.DictCursor
+            )
+        return _pool
+
 
 def get_connection():
-    """Create and return a database connection."""
+    """Return a pooled database connection. Calling close() on it returns it to the pool."""
     try:
-        connection = pymysql.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            charset='utf8mb4',
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        return connection
+        return _get_pool().connection()
     except pymysql.Error as e:
-        print(f"Error connecting to MariaDB: {e}")
+        logger.error(f"Error connecting to MariaDB: {e}")
         raise
 
 
+def get_stream_cursor(connection):
+    """
+    Return an unbuffered (server-side) dict cursor for large result sets.
+    Rows are read while iterating, so the result must be fully consumed before the next query.
+    """
+    return connection.cursor(pymysql.cursors.SSDictCursor)
+
+
+def close_pool():
+    """Close all pooled connections."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def _jit(func):
+    """
+    Compile func with Numba when USE_NUMBA is set and Numba is installed. The machine code is
+    cached on disk, so only the first run pays the compile time. fastmath leaves out the no-NaN
+    assumption because ships without a known position are passed as NaN.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, fastmath={'contract', 'afn', 'arcp', 'reassoc', 'nsz'})(func)
+
+
+@_jit
 def haversine(lat1, lon1, lat2, lon2):
-    # Earth radius in meters
-    R = 6371000
+    R = EARTH_RADIUS_M
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlambda = math.radians(lon2 - lon1)
@@ -40,6 +109,73 @@ def haversine(lat1, lon1, lat2, lon2):
     return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
+@_jit
+def _haversine_loop(lat1, lon1, lat2, lon2):
+    """haversine() over equal-length 1-D float arrays, as one compiled loop."""
+    out = np.empty(lat2.shape[0])
+    for i in range(lat2.shape[0]):
+        out[i] = haversine(lat1[i], lon1[i], lat2[i], lon2[i])
+    return out
+
+
+def haversine_vec(lat1, lon1, lats, lons):
+    """
+    Vectorized haversine. Returns a NumPy array of distances in meters between (lat1, lon1)
+    and each (lats[i], lons[i]). All arguments may be scalars or arrays (they broadcast).
+    """
+    if numba is not None:
+        args = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lats, lons)])
+        return _haversine_loop(*[a.ravel().copy() for a in args]).reshape(args[0].shape)
+
+    R = EARTH_RADIUS_M
+    phi1, phi2 = np.radians(lat1), np.radians(lats)
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.subtract(lons, lon1))
+    a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def get_latest_positions(cursor, mmsis):
+    """
+    Fetches the latest position of every MMSI in one query.
+    Returns a dict: {str(mmsi): (ship_lat, ship_lon)}. MMSIs without a position are left out.
+    """
+    mmsis = {str(mmsi) for mmsi in mmsis}
+    if not mmsis:
+        return {}
+    # Groupwise max: the MAX(unix_time) subquery is a loose index scan on (mmsi, unix_time), so only
+    # the latest row of each vessel is read, not its whole position history. If two rows share the
+    # latest unix_time, both are returned and the dict below keeps one of them.
+    cursor.execute(
+        "SELECT a.mmsi, a.latitude, a.longitude FROM aivdm a "
+        "JOIN (SELECT mmsi, MAX(unix_time) AS unix_time FROM aivdm WHERE mmsi IN %(mmsis)s GROUP BY mmsi) latest "
+        "ON a.mmsi = latest.mmsi AND a.unix_time = latest.unix_time",
+        {'mmsis': tuple(mmsis)}
+    )
+    return {str(row['mmsi']): (row['latitude'], row['longitude']) for row in cursor}
+
+
+def check_ships_radius(cursor, mmsis, center_lats, center_lons, radii_m, closer):
+    """
+    Batch version of is_ship_within_radius: one SQL query and one vectorized distance computation
+    for all alarms. All arguments are sequences of equal length; closer[i] selects "within" (True)
+    or "outside" (False) for alarm i.
+    Returns a tuple of arrays: (triggered, distance, ship_lat, ship_lon). Alarms whose ship has no
+    known position get triggered=False and NaN for the other values.
+    """
+    positions = get_latest_positions(cursor, mmsis)
+    ship_pos = np.array([positions.get(str(mmsi), (np.nan, np.nan)) for mmsi in mmsis], dtype=float).reshape(-1, 2)
+    ship_lats, ship_lons = ship_pos[:, 0], ship_pos[:, 1]
+
+    distances = haversine_vec(
+        np.asarray(center_lats, dtype=float), np.asarray(center_lons, dtype=float), ship_lats, ship_lons
+    )
+    radii_m = np.asarray(radii_m, dtype=float)
+    # Comparisons against NaN are False, so ships without a position never trigger
+    triggered = np.where(np.asarray(closer, dtype=bool), distances < radii_m, distances > radii_m)
+    return triggered, distances, ship_lats, ship_lons
+
+
 def is_ship_within_radius(cursor, mmsi, center_lat, center_lon, radius_m, closer=True):
     """
     Checks if a ship is within (closer=True) or outside (closer=False) a radius in meters from a point.
@@ -51,11 +187,11 @@ def is_ship_within_radius(cursor, mmsi, center_lat, center_lon, radius_m, closer
     )
     row = cursor.fetchone()
     if not row:
-        print("No position found for MMSI", mmsi)
+        logger.warning("No position found for MMSI %s", mmsi)
         return False, None, None, None
     ship_lat, ship_lon = row['latitude'], row['longitude']
     distance = haversine(center_lat, center_lon, ship_lat, ship_lon)
-    print(f"Distance for MMSI {mmsi}: {distance} meters")
+    logger.debug("Distance for MMSI %s: %s meters", mmsi, distance)
     triggered = distance < radius_m if closer else distance > radius_m
     return triggered, distance, ship_lat, ship_lon
 
@@ -72,30 +208,32 @@ def main():
     """Test the database connection."""
     try:
         conn = get_connection()
-        print("Successfully connected to MariaDB!")
+        logger.info("Successfully connected to MariaDB!")
         
         with conn.cursor() as cursor:
             cursor.execute("SELECT VERSION()")
             result = cursor.fetchone()
-            print(f"Database version: {result}")
+            logger.info(f"Database version: {result}")
         
         with conn.cursor() as cursor:
             try:
                 with conn.cursor() as cursor:
                     result = is_ship_within_radius(cursor, 246571000, 55.757911, 12.453396, 13000)
                     if result:
-                        print("Ship is within radius.")
+                        logger.info("Ship is within radius.")
                     else:
-                        print("Ship is outside radius.")
+                        logger.info("Ship is outside radius.")
             finally:
                 conn.close()
                 
         # conn.close()
-        print("Connection closed.")
+        close_pool()
+        logger.info("Connection closed.")
         
     except Exception as e:
-        print(f"Failed to connect: {e}")
+        logger.error(f"Failed to connect: {e}")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main()